@@ -0,0 +1,192 @@
+"""
+Byte-level metadata stripping for JPEG and PNG files.
+These helpers drop EXIF/XMP/IPTC and text segments by walking the container
+structure, so the compressed pixel data is copied through untouched and never
+decoded or re-encoded.
+"""
+
+import struct
+
+JPEG_SOI = b"\xff\xd8"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# JPEG markers that stand alone (no length field follows them).
+_JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+_JPEG_SOS = 0xDA
+_JPEG_EOI = 0xD9
+_JPEG_COM = 0xFE
+
+# Start Of Frame markers for progressive and lossless coding, whose files are
+# made of several scans.
+_JPEG_MULTI_SCAN_SOF = {0xC2, 0xC3, 0xC6, 0xC7, 0xCA, 0xCB, 0xCE, 0xCF}
+
+# PNG ancillary chunks that only carry metadata.
+_PNG_METADATA_CHUNKS = {b"eXIf", b"tEXt", b"iTXt", b"zTXt", b"tIME"}
+
+
+def _is_jpeg_metadata_segment(marker, payload):
+    """
+    Returns True for APPn/COM segments that carry metadata.
+    APP0 (JFIF), APP2 ICC profiles and APP14 (Adobe colour transform) are
+    kept because decoders need them to render the image correctly.
+    """
+    if marker == _JPEG_COM:
+        return True
+    if not 0xE0 <= marker <= 0xEF:
+        return False
+    if marker in (0xE0, 0xEE):
+        return False
+    if marker == 0xE2:
+        return not payload.startswith(b"ICC_PROFILE\x00")
+    return True
+
+
+def _iter_jpeg_header(data):
+    """
+    Yields (marker, start, end) for each JPEG header segment, up to and
+    including the first Start Of Scan. Raises ValueError if the data ends or
+    is malformed before that point.
+    """
+    size = len(data)
+    pos = 2
+    while True:
+        if pos + 4 > size or data[pos] != 0xFF:
+            raise ValueError("Truncated or malformed JPEG header")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker.
+            pos += 1
+            continue
+        if marker in _JPEG_STANDALONE_MARKERS:
+            yield marker, pos, pos + 2
+            pos += 2
+            continue
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        end = pos + 2 + length
+        if length < 2 or end > size:
+            raise ValueError("Invalid JPEG segment length")
+        yield marker, pos, end
+        pos = end
+        if marker == _JPEG_SOS:
+            return
+
+
+def jpeg_head_is_clean(head):
+    """
+    Checks the leading bytes of a file for a JPEG header without metadata.
+    Returns True only if the whole header (up to Start Of Scan) fits in
+    `head`, contains no metadata segments and describes a baseline or
+    extended sequential image. Progressive files are rejected because they
+    can carry further segments between their scans.
+    The caller still has to check that nothing follows the EOI marker.
+    """
+    if not head.startswith(JPEG_SOI):
+        return False
+    try:
+        for marker, start, end in _iter_jpeg_header(head):
+            if marker in _JPEG_MULTI_SCAN_SOF:
+                return False
+            if _is_jpeg_metadata_segment(marker, head[start + 4:end]):
+                return False
+    except ValueError:
+        return False
+    return True
+
+
+def jpeg_ends_at_eoi(tail):
+    """
+    Checks that the last bytes of a JPEG file are its EOI marker, i.e. no
+    trailer (MPF images, vendor data) follows the image.
+    """
+    return tail.endswith(b"\xff\xd9")
+
+
+def strip_jpeg(data):
+    """
+    Returns a copy of a JPEG byte string without metadata segments.
+    Anything after the EOI marker (e.g. MPF secondary images or vendor
+    trailers) is dropped as well. Raises ValueError on malformed input.
+    """
+    if not data.startswith(JPEG_SOI):
+        raise ValueError("Not a JPEG file")
+
+    view = memoryview(data)
+    size = len(data)
+    parts = [view[:2]]
+    pos = 2
+
+    # Header segments, up to the first Start Of Scan.
+    for marker, start, end in _iter_jpeg_header(data):
+        if not _is_jpeg_metadata_segment(marker, data[start + 4:end]):
+            parts.append(view[start:end])
+        pos = end
+
+    # Entropy-coded data. Progressive files interleave further tables and
+    # scans here, so keep walking markers until EOI.
+    scan_start = pos
+    while True:
+        pos = data.find(b"\xff", pos)
+        if pos == -1 or pos + 1 >= size:
+            raise ValueError("JPEG is missing its EOI marker")
+        marker = data[pos + 1]
+        if marker == 0x00 or marker == 0xFF or marker in _JPEG_STANDALONE_MARKERS:
+            # Stuffed byte, fill byte or restart marker.
+            pos += 1 if marker == 0xFF else 2
+            continue
+        if marker == _JPEG_EOI:
+            parts.append(view[scan_start:pos + 2])
+            break
+        if pos + 4 > size:
+            raise ValueError("Truncated JPEG segment")
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        end = pos + 2 + length
+        if length < 2 or end > size:
+            raise ValueError("Invalid JPEG segment length")
+        if _is_jpeg_metadata_segment(marker, data[pos + 4:end]):
+            parts.append(view[scan_start:pos])
+            scan_start = end
+        pos = end
+
+    return b"".join(parts)
+
+
+def strip_png(data):
+    """
+    Returns a copy of a PNG byte string without eXIf/text/time chunks.
+    Raises ValueError on malformed input.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG file")
+
+    view = memoryview(data)
+    size = len(data)
+    parts = [view[:8]]
+    pos = 8
+
+    while True:
+        if pos + 12 > size:
+            raise ValueError("PNG is missing its IEND chunk")
+        length, chunk_type = struct.unpack_from(">I4s", data, pos)
+        end = pos + 12 + length
+        if end > size:
+            raise ValueError("Invalid PNG chunk length")
+        if chunk_type not in _PNG_METADATA_CHUNKS:
+            parts.append(view[pos:end])
+        pos = end
+        if chunk_type == b"IEND":
+            break
+
+    return b"".join(parts)
+
+
+def strip_metadata(data):
+    """
+    Strips metadata from JPEG or PNG bytes without decoding the image.
+    Returns None when the format is not handled here, so the caller can fall
+    back to a full decode/re-encode. Raises ValueError on malformed input.
+    """
+    if data.startswith(JPEG_SOI):
+        return strip_jpeg(data)
+    if data.startswith(PNG_SIGNATURE):
+        return strip_png(data)
+    return None
@@ -2,8 +2,18 @@
 Local Storage Watcher for Firebase Storage
 This script monitors Firebase Storage for new file uploads and automatically
 triggers Vision AI processing locally for testing purposes.
+
+New uploads are received from a Pub/Sub subscription fed by Cloud Storage
+object notifications. One-time setup (requires google-cloud-pubsub locally):
+
+    gsutil notification create -t <topic> -f json -e OBJECT_FINALIZE -p processed/ gs://<bucket>
+    gcloud pubsub subscriptions create <subscription> --topic <topic>
+
+Set STORAGE_SUBSCRIPTION to the subscription name. Without it the script
+falls back to polling the bucket.
 """
 
+import json
 import os
 import time
 import firebase_admin
@@ -17,17 +27,96 @@ load_dotenv()
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
-def watch_storage_uploads(bucket_name=None, check_interval=5, watch_prefix="processed/"):
+# Default bucket derived from the project. When GCLOUD_PROJECT is unset this
+# stays None and firebase_admin uses the app's configured storageBucket,
+# instead of failing on None + str.
+_PROJECT = os.environ.get('GCLOUD_PROJECT') or ''
+_BUCKET = f'{_PROJECT}.appspot.com' if _PROJECT else None
+
+def watch_storage_uploads(subscription=None, watch_prefix="processed/"):
+    """
+    Processes new uploads as Cloud Storage notifications arrive on Pub/Sub.
+    Nothing is listed or polled; work only happens when an object is finalized.
+    
+    Args:
+        subscription: Subscription name or full path (defaults to STORAGE_SUBSCRIPTION)
+        watch_prefix: The prefix/folder to process uploads from (e.g., "processed/")
+
+    Raises:
+        ValueError: If no subscription is configured, or a bare subscription
+            name is given while GCLOUD_PROJECT is unset.
+    """
+    from google.cloud import pubsub_v1
+
+    subscription = subscription or os.environ.get("STORAGE_SUBSCRIPTION")
+    if not subscription:
+        raise ValueError("No subscription given. Pass one or set STORAGE_SUBSCRIPTION.")
+    if "/" not in subscription and not _PROJECT:
+        raise ValueError(
+            f"Cannot build the path for subscription '{subscription}' without a project. "
+            "Set GCLOUD_PROJECT or pass the full projects/<project>/subscriptions/<name> path."
+        )
+
+    subscriber = pubsub_v1.SubscriberClient()
+    if "/" not in subscription:
+        subscription = subscriber.subscription_path(_PROJECT, subscription)
+
+    print(f"Starting local storage watcher...")
+    print(f"Subscription: {subscription}")
+    print(f"Watching prefix: {watch_prefix}")
+    print(f"Press Ctrl+C to stop\n")
+
+    def callback(message):
+        attributes = message.attributes
+        bucket_name = attributes.get("bucketId")
+        file_path = attributes.get("objectId", "")
+
+        if attributes.get("eventType") != "OBJECT_FINALIZE" or not file_path.startswith(watch_prefix):
+            message.ack()
+            return
+
+        payload = json.loads(message.data or b"{}")
+        content_type = payload.get("contentType") or ""
+        if not content_type.startswith("image/"):
+            message.ack()
+            return
+
+        print(f"\n{'='*60}")
+        print(f"🔍 NEW IMAGE DETECTED: {file_path}")
+        print(f"{'='*60}")
+
+        # Run Vision AI analysis
+        try:
+            process_image_without_metadata_check(bucket_name, file_path, os.environ.get("GEMINI_API_KEY"))
+            print(f"✅ Successfully analyzed: {file_path}")
+        except Exception as e:
+            print(f"❌ Error analyzing {file_path}: {e}")
+
+        print(f"{'='*60}\n")
+        # Acknowledge even on failure so a bad image is not redelivered forever.
+        message.ack()
+
+    streaming_pull = subscriber.subscribe(subscription, callback=callback)
+    with subscriber:
+        try:
+            streaming_pull.result()
+        except KeyboardInterrupt:
+            streaming_pull.cancel()
+            streaming_pull.result()
+            print("\n\nStopping storage watcher. Goodbye!")
+
+def poll_storage_uploads(bucket_name=None, check_interval=5, watch_prefix="processed/"):
     """
-    Watches Firebase Storage for new uploads and processes them with Vision AI.
+    Polls Firebase Storage for new uploads and processes them with Vision AI.
+    Fallback for when no Pub/Sub subscription is configured.
     
     Args:
         bucket_name: The name of the storage bucket (defaults to project bucket)
         check_interval: How often to check for new files (in seconds)
         watch_prefix: The prefix/folder to watch for uploads (e.g., "processed/")
     """
-    if not bucket_name:
-        bucket_name = os.environ.get('GCLOUD_PROJECT') + '.appspot.com'
+    bucket = storage.bucket(bucket_name or _BUCKET)
+    bucket_name = bucket.name
     
     print(f"Starting local storage watcher...")
     print(f"Bucket: {bucket_name}")
@@ -35,41 +124,51 @@ def watch_storage_uploads(bucket_name=None, check_interval=5, watch_prefix="proc
     print(f"Check interval: {check_interval} seconds")
     print(f"Press Ctrl+C to stop\n")
     
-    bucket = storage.bucket(bucket_name)
-    processed_files = set()
-    
-    # Initial scan to mark existing files as already processed
-    print("Scanning for existing files...")
-    blobs = bucket.list_blobs(prefix=watch_prefix)
-    for blob in blobs:
-        if blob.content_type and blob.content_type.startswith("image/"):
-            processed_files.add(blob.name)
-    print(f"Found {len(processed_files)} existing image(s). These will be skipped.\n")
+    # Instead of remembering every file name, keep a creation-time watermark:
+    # anything created after it is new. Names under the prefix are not
+    # ordered by upload time, so a name-based start_offset would miss files.
+    # The names sharing the watermark's exact timestamp are kept to break ties.
+    # The watermark starts at the newest existing file, so it only ever holds
+    # server timestamps and a skewed local clock cannot hide new uploads.
+    list_fields = "items(name,contentType,timeCreated),nextPageToken"
+    existing = list(bucket.list_blobs(prefix=watch_prefix, fields=list_fields))
+    watermark = max((blob.time_created for blob in existing), default=None)
+    names_at_watermark = {blob.name for blob in existing if blob.time_created == watermark}
+    print("Existing files will be skipped.\n")
     
     try:
         while True:
-            # List all blobs with the specified prefix
-            blobs = bucket.list_blobs(prefix=watch_prefix)
+            # List blobs with the specified prefix, fetching only the fields we read
+            blobs = bucket.list_blobs(prefix=watch_prefix, fields=list_fields)
+            new_blobs = [
+                blob for blob in blobs
+                if watermark is None
+                or blob.time_created > watermark
+                or (blob.time_created == watermark and blob.name not in names_at_watermark)
+            ]
+            new_blobs.sort(key=lambda blob: blob.time_created)
             
-            for blob in blobs:
-                # Check if it's an image and we haven't processed it yet
+            for blob in new_blobs:
+                # Advance the watermark before running analysis
+                if watermark is None or blob.time_created > watermark:
+                    watermark = blob.time_created
+                    names_at_watermark = set()
+                names_at_watermark.add(blob.name)
+
+                # Check if it's an image
                 if blob.content_type and blob.content_type.startswith("image/"):
-                    if blob.name not in processed_files:
-                        print(f"\n{'='*60}")
-                        print(f"🔍 NEW IMAGE DETECTED: {blob.name}")
-                        print(f"{'='*60}")
-                        
-                        # Mark as processed before running analysis
-                        processed_files.add(blob.name)
-                        
-                        # Run Vision AI analysis
-                        try:
-                            process_image_without_metadata_check(bucket_name, blob.name)
-                            print(f"✅ Successfully analyzed: {blob.name}")
-                        except Exception as e:
-                            print(f"❌ Error analyzing {blob.name}: {e}")
-                        
-                        print(f"{'='*60}\n")
+                    print(f"\n{'='*60}")
+                    print(f"🔍 NEW IMAGE DETECTED: {blob.name}")
+                    print(f"{'='*60}")
+                    
+                    # Run Vision AI analysis
+                    try:
+                        process_image_without_metadata_check(bucket_name, blob.name, os.environ.get("GEMINI_API_KEY"))
+                        print(f"✅ Successfully analyzed: {blob.name}")
+                    except Exception as e:
+                        print(f"❌ Error analyzing {blob.name}: {e}")
+                    
+                    print(f"{'='*60}\n")
             
             # Wait before checking again
             time.sleep(check_interval)
@@ -85,8 +184,7 @@ def process_single_file(bucket_name=None, file_path=None):
         bucket_name: The name of the storage bucket
         file_path: The path to the file in storage
     """
-    if not bucket_name:
-        bucket_name = os.environ.get('GCLOUD_PROJECT') + '.appspot.com'
+    bucket_name = storage.bucket(bucket_name or _BUCKET).name
     
     if not file_path:
         print("Error: file_path is required")
@@ -96,7 +194,7 @@ def process_single_file(bucket_name=None, file_path=None):
     print(f"Bucket: {bucket_name}\n")
     
     try:
-        process_image_without_metadata_check(bucket_name, file_path)
+        process_image_without_metadata_check(bucket_name, file_path, os.environ.get("GEMINI_API_KEY"))
         print(f"\n✅ Successfully analyzed: {file_path}")
     except Exception as e:
         print(f"\n❌ Error analyzing {file_path}: {e}")
@@ -115,10 +213,15 @@ if __name__ == "__main__":
             print("Usage:")
             print("  Watch mode:   python local_storage_watcher.py")
             print("  Single file:  python local_storage_watcher.py --single <file_path> [bucket_name]")
+    elif os.environ.get("STORAGE_SUBSCRIPTION"):
+        # Default: Watch mode, driven by Pub/Sub notifications
+        watch_storage_uploads(
+            watch_prefix="processed/"  # Watch the processed/ folder
+        )
     else:
-        # Default: Watch mode
+        # No subscription configured: fall back to polling
         # You can customize these parameters:
-        watch_storage_uploads(
+        poll_storage_uploads(
             bucket_name=None,  # Uses default project bucket
             check_interval=5,  # Check every 5 seconds
             watch_prefix="processed/"  # Watch the processed/ folder
@@ -1,119 +1,254 @@
 # main.py
+import io
 import os
-import tempfile
+import queue
+import threading
 from PIL import Image, UnidentifiedImageError  # <-- Import UnidentifiedImageError
 
+try:
+    import pyvips
+except (ImportError, OSError):
+    # libvips is optional; without it every non-JPEG/PNG image goes through Pillow.
+    pyvips = None
+
 import firebase_admin
 from firebase_functions import storage_fn, scheduler_fn
-from firebase_admin import storage
-
-# Import the analyze_image function from vision.py
-from vision import analyze_image, process_image_without_metadata_check
+from firebase_admin import db, storage
+from google.api_core.exceptions import NotFound, RequestRangeNotSatisfiable
+
+# Import the analysis functions from vision.py
+from vision import (
+    analyze_image,
+    analyze_images,
+    db_key,
+    SERVER_TIMESTAMP,
+    generation_seen,
+    get_bucket,
+    prune_seen_generations,
+    seen_generation_key,
+    tagged_keys,
+)
+from exif import jpeg_ends_at_eoi, jpeg_head_is_clean, strip_metadata
 
 # Initialize the Firebase Admin SDK.
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
+# Resumable uploads above the single-request limit are sent in 8MB chunks
+# instead of the library's 256KB default (must be a multiple of 256KB).
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Bytes read from the start of an upload to check for metadata. JPEG metadata
+# lives in the header, which normally fits well within this.
+PROBE_BYTES = 64 * 1024
+
+# Number of images the scheduled scans handle concurrently. The work is
+# I/O-bound (GCS, Vision, Gemini), so this can exceed the CPU count.
+SCAN_MAX_WORKERS = int(os.environ.get("SCAN_MAX_WORKERS", "16"))
+
+# Images listed ahead of the workers in scan_unprocessed_images.
+SCAN_QUEUE_SIZE = 64
+
+# Only the object properties the scans read are requested from list_blobs.
+LIST_BLOB_FIELDS = "items(name,generation,contentType,metadata,size,md5Hash),nextPageToken"
+
+# Server-side filter for image files in list_blobs; globs are case-sensitive.
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp", "gif", "heic", "heif", "tif", "tiff", "bmp")
+IMAGE_MATCH_GLOB = "**.{" + ",".join(IMAGE_EXTENSIONS + tuple(ext.upper() for ext in IMAGE_EXTENSIONS)) + "}"
+
+# RTDB node indexing the upload paths process_image has already handled.
+PROCESSED_PATHS_PATH = "processed_paths"
+
+# How long seen object generations are remembered for duplicate-event checks.
+SEEN_GENERATION_TTL_SECONDS = 7 * 24 * 60 * 60
 
-def process_image(bucket_name, file_path, content_type, uid=None, public=None):
+# Maps a libvips loader name prefix (e.g. "webp" from "webpload_buffer") to
+# the suffix that selects the matching saver.
+VIPS_SAVE_SUFFIXES = {
+    "jpeg": ".jpg",
+    "png": ".png",
+    "webp": ".webp",
+    "gif": ".gif",
+    "tiff": ".tif",
+    "heif": ".heic",
+}
+
+
+def processed_path(file_path):
+    """
+    Returns the path the sanitized copy of an uploaded image is written to.
+    """
+    return f"processed/{os.path.basename(file_path)}"
+
+
+def strip_with_vips(data):
+    """
+    Re-encodes an image with libvips, dropping all metadata except the ICC
+    colour profile on save, which decoders need to render the image correctly.
+    libvips streams the image instead of decoding it fully into memory.
+    Returns None if libvips is unavailable or cannot save the format.
+    Raises pyvips.Error if the data cannot be decoded.
+    """
+    if pyvips is None:
+        return None
+
+    img = pyvips.Image.new_from_buffer(data, "", access="sequential")
+    loader = img.get("vips-loader")
+    suffix = VIPS_SAVE_SUFFIXES.get(loader.split("load")[0])
+    if suffix is None:
+        return None
+    if suffix == ".heic" and img.get_typeof("heif-compression") and img.get("heif-compression") == "av1":
+        suffix = ".avif"
+    return img.write_to_buffer(suffix, keep="icc")
+
+
+def mark_processed(file_path):
+    """
+    Records an upload path in the processed-paths index.
+    """
+    db.reference(f"{PROCESSED_PATHS_PATH}/{db_key(file_path)}").set(SERVER_TIMESTAMP)
+
+
+def processed_keys():
+    """
+    Returns the set of db_key()-escaped upload paths that have been processed.
+    Fetched shallowly, so only the keys are transferred.
+    """
+    return set(db.reference(PROCESSED_PATHS_PATH).get(shallow=True) or {})
+
+
+def process_image(bucket_name, file_path, content_type, uid=None, public=None, size=None, generation=None):
     """
     Downloads an image, removes its EXIF data, and saves it to a new location.
-    Returns the destination path of the processed image.
+    The whole round-trip happens in memory; nothing is written to disk.
+    Pass the object's size and generation when known: the size tells whether
+    the first read got the whole file, and the generation pins every read and
+    the copy to the same version of the object.
+    The upload path is recorded in the processed-paths index on success.
+    Returns the processed blob, or None if the file is not a valid image or
+    that generation no longer exists.
     """
     print(f"Processing image for EXIF removal: {file_path}")
 
-    bucket = storage.bucket(bucket_name)
-    source_blob = bucket.blob(file_path)
-
-    # Use a temporary file to download and process the image.
-    _, temp_local_path = tempfile.mkstemp()
+    bucket = get_bucket(bucket_name)
+    source_blob = bucket.blob(file_path, generation=generation)
+    destination_path = processed_path(file_path)
 
     try:
-        # Download the image to the temporary file.
-        source_blob.download_to_filename(temp_local_path)
-        print(f"Image downloaded to temporary file: {temp_local_path}")
+        # Probe the start of the file first. A sequential JPEG whose header
+        # carries no metadata and that ends right at its EOI marker is copied
+        # server-side, without passing its bytes through here.
+        data = source_blob.download_as_bytes(start=0, end=PROBE_BYTES - 1)
+        complete = len(data) >= size if size is not None else len(data) < PROBE_BYTES
+        if jpeg_head_is_clean(data):
+            tail = data if complete else source_blob.download_as_bytes(start=-2)
+            if jpeg_ends_at_eoi(tail):
+                destination_blob = bucket.copy_blob(
+                    source_blob, bucket, destination_path, source_generation=generation
+                )
+                mark_processed(file_path)
+                print(f"Image has no EXIF data. Copied as is to '{destination_path}'.")
+                return destination_blob
+
+        # Download only the rest of the image straight into memory, unless the
+        # probe already covered the whole file.
+        if not complete:
+            try:
+                data += source_blob.download_as_bytes(start=PROBE_BYTES)
+            except RequestRangeNotSatisfiable:
+                # Size unknown and the object is exactly PROBE_BYTES long.
+                pass
+    except NotFound:
+        print(f"'{file_path}' (generation {generation}) no longer exists. Skipping.")
+        return None
+    print(f"Image downloaded ({len(data)} bytes).")
+
+    # Fast path: drop metadata segments from JPEG/PNG bytes directly,
+    # without decoding or re-encoding the pixel data.
+    try:
+        stripped = strip_metadata(data)
+    except ValueError as e:
+        print(f"Fast EXIF strip failed for '{file_path}' ({e}). Falling back to a full re-encode.")
+        stripped = None
+
+    if stripped is None:
+        try:
+            stripped = strip_with_vips(data)
+        except pyvips.Error as e:
+            # Let Pillow make the final call on whether this is an image.
+            print(f"libvips could not process '{file_path}' ({e}). Falling back to Pillow.")
 
+    if stripped is None:
         # --- FIX: Added try/except block for PIL errors ---
         try:
             # Open the image and remove EXIF data by saving it without the data.
-            with Image.open(temp_local_path) as img:
+            with Image.open(io.BytesIO(data)) as img:
                 # Get the format before closing
                 img_format = img.format
-                # By not passing exif data to the save method, it's stripped.
-                img.save(temp_local_path, format=img_format)
-            # Image is now properly closed after exiting the context manager
-            print("EXIF data removed successfully.")
-        
+                # Save with an explicitly empty EXIF block.
+                save_kwargs = {"format": img_format, "exif": b""}
+                out = io.BytesIO()
+                if img_format == "JPEG":
+                    # Reuse the source quantization tables and subsampling
+                    # so the re-encode adds no extra loss. Pillow also copies
+                    # the source's COM segment unless given an empty comment.
+                    save_kwargs.update(quality="keep", subsampling="keep", comment=b"")
+                    img.save(out, **save_kwargs)
+                else:
+                    # Some encoders (e.g. TIFF) copy XMP/IPTC tags from the
+                    # source image, so save a fresh image built from the raw
+                    # pixel buffer. tobytes/frombytes is a single buffer copy.
+                    clean = Image.frombytes(img.mode, img.size, img.tobytes())
+                    if img.palette is not None:
+                        clean.putpalette(img.getpalette(img.palette.mode), img.palette.mode)
+                    if "transparency" in img.info:
+                        save_kwargs["transparency"] = img.info["transparency"]
+                    clean.save(out, **save_kwargs)
+            stripped = out.getvalue()
+
         except UnidentifiedImageError:
             # This catches corrupted, 0-byte, or non-image files
             print(f"Error: Cannot identify image file '{file_path}'. It may be corrupted or not a valid image. Skipping EXIF removal.")
             return None  # Return None to signal failure
         # --- END FIX ---
 
+    del data
+    print("EXIF data removed successfully.")
 
-        # Define a new destination path in the 'processed/' subfolder.
-        file_name = os.path.basename(file_path)
-        destination_path = f"processed/{file_name}"
-        destination_blob = bucket.blob(destination_path)
+    # Write to the destination path in the 'processed/' subfolder.
+    destination_blob = bucket.blob(destination_path)
+    destination_blob.chunk_size = UPLOAD_CHUNK_SIZE
 
-        new_metadata = {}
-        if uid:
-            new_metadata["uid"] = uid
-        if public:
-            new_metadata["public"] = public
+    new_metadata = {}
+    if uid:
+        new_metadata["uid"] = uid
+    if public:
+        new_metadata["public"] = public
 
-        if new_metadata:
-            destination_blob.metadata = new_metadata
-
-        # Upload the sanitized image to the new path.
-        destination_blob.upload_from_filename(
-            temp_local_path,
-            content_type=content_type
-        )
-        print(f"Sanitized image uploaded to '{destination_path}'.")
-        
-        return destination_path
-
-    finally:
-        # Clean up the temporary file.
-        # On Windows, we need to ensure the file is released before deletion
-        try:
-            os.remove(temp_local_path)
-            print(f"Cleaned up temporary file and finished processing.")
-        except PermissionError:
-            print(f"Warning: Could not delete temporary file {temp_local_path}. It may be cleaned up later by the system.")
+    if new_metadata:
+        destination_blob.metadata = new_metadata
 
+    # Upload the sanitized image to the new path. Payloads up to 8MB go out
+    # as a single multipart request; larger ones use UPLOAD_CHUNK_SIZE chunks.
+    # The bytes were produced in memory moments ago, so skip the client-side
+    # checksum pass over the whole payload.
+    destination_blob.upload_from_string(
+        stripped,
+        content_type=content_type,
+        checksum=None
+    )
+    mark_processed(file_path)
+    print(f"Sanitized image uploaded to '{destination_path}'.")
 
+    return destination_blob
 
 
-@storage_fn.on_object_finalized(bucket=os.environ.get('GCLOUD_PROJECT') + '.appspot.com', memory=512, cpu=1, region='us-central1', timeout_sec=120, secrets=["GEMINI_API_KEY"])
-def analyze_processed_image(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
-    """
-    Triggers when a file is uploaded to Storage.
-    Only analyzes images in the 'processed/' or 'photos/' directories.
-    """
-    bucket_name = event.data.bucket
-    file_path = event.data.name
-    metadata = event.data.metadata or {}
-
-    # 1. Exit if the file is not in a directory we want to analyze.
-    if not ('processed/' in file_path or 'photos/' in file_path):
-        print(f"File '{file_path}' is not in a monitored directory. Skipping.")
-        return
-
-    # 2. Get the secret key value from os.environ
-    key = os.environ.get("GEMINI_API_KEY")
-
-    # 3. Pass the key and metadata to the analysis function.
-    analyze_image(bucket_name, file_path, key, metadata)
-
-
-@storage_fn.on_object_finalized(secrets=["GEMINI_API_KEY"])
+@storage_fn.on_object_finalized(memory=512, timeout_sec=300, secrets=["GEMINI_API_KEY"])
 def remove_exif_on_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
     """
     Triggers when a new file is uploaded to Firebase Storage,
     removes its EXIF data, saves it to a new location,
-    and triggers image analysis.
+    and analyzes the sanitized copy in the same invocation.
     """
     bucket_name = event.data.bucket
     file_path = event.data.name
@@ -140,17 +275,37 @@ def remove_exif_on_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectD
         print(f"File '{file_path}' is already processed. Skipping.")
         return
 
-    # Process the image and get the destination path
-    destination_path = process_image(bucket_name, file_path, content_type, uid, public)
+    # 4. Exit if this event is a redelivery of one that was already handled
+    # (storage events are delivered at least once), before any processing.
+    seen_key = seen_generation_key(file_path, event.data.generation)
+    if generation_seen(seen_key):
+        print(f"Generation {event.data.generation} of '{file_path}' was already handled. Skipping.")
+        return
+
+    # Process the image and get the sanitized copy
+    processed_blob = process_image(
+        bucket_name, file_path, content_type, uid, public,
+        size=file_size, generation=event.data.generation,
+    )
     
-    # Run vision analysis on the processed image
+    # Run vision analysis on the processed image here rather than in a
+    # second trigger on its upload, saving a function invocation per image.
     # This 'if' block will now also catch the 'None' return from a failed process_image
-    # if destination_path:
-    #     # Get the secret key value from os.environ
-    #     key = os.environ.get("GEMINI_API_KEY")
-    #     # Pass the key to the analysis function
-    #     process_image_without_metadata_check(bucket_name, destination_path, gemini_api_key=key)
-
+    if processed_blob:
+        # Get the secret key value from os.environ
+        key = os.environ.get("GEMINI_API_KEY")
+        # Pass the key to the analysis function. It records the event's
+        # seen-generation key with its results, and the processed copy
+        # carries the upload's metadata, so it is passed on with the copy's
+        # MD5 hash instead of being read back from Storage.
+        analyze_image(
+            bucket_name,
+            processed_blob.name,
+            key,
+            metadata=metadata,
+            seen_key=seen_key,
+            md5_hash=processed_blob.md5_hash,
+        )
 
 
 @scheduler_fn.on_schedule(schedule="every 24 hours")
@@ -163,34 +318,67 @@ def scan_unprocessed_images(event: scheduler_fn.ScheduledEvent) -> None:
     # Get the default bucket
     bucket = storage.bucket()
     
-    blobs = bucket.list_blobs()
-    
-    for blob in blobs:
-        file_path = blob.name
-        content_type = blob.content_type
-        file_size = blob.size # <-- Also good to check size here
-
-        # 1. Exit if the file is not an image.
-        if not content_type or not content_type.startswith("image/"):
-            continue
-
-        # 2. Exit if the file is empty.
-        if file_size == 0:
-            continue
-
-        # 3. Exit if the file is already processed.
-        if 'processed/' in file_path:
-            continue
-            
-        # 4. Check for a custom metadata flag to avoid re-processing
-        if blob.metadata and blob.metadata.get('processed') == 'true':
-            continue
-
-        print(f"Found unprocessed image: {file_path}")
-        uid = blob.metadata.get("uid") if blob.metadata else None
-        public = blob.metadata.get("public") if blob.metadata else None
-        process_image(bucket.name, file_path, content_type, uid, public)
+    # Let GCS filter by extension so non-images are never returned.
+    blobs = bucket.list_blobs(match_glob=IMAGE_MATCH_GLOB, fields=LIST_BLOB_FIELDS)
+    # One read of the processed-paths index replaces a check per image.
+    processed = processed_keys()
+
+    # Workers pull images off a bounded queue while the listing is still
+    # paging, so processing starts with the first page instead of after the
+    # last one. Each image is dominated by GCS round-trips, not CPU.
+    work = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+
+    def process_queued_images():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            file_path, content_type, uid, public, size, generation = item
+            try:
+                process_image(bucket.name, file_path, content_type, uid, public, size, generation)
+            except Exception as e:
+                print(f"Error processing '{file_path}': {e}")
+
+    workers = [threading.Thread(target=process_queued_images) for _ in range(SCAN_MAX_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for blob in blobs:
+            file_path = blob.name
+            content_type = blob.content_type
+            file_size = blob.size # <-- Also good to check size here
+
+            # 1. Exit if the file is not an image. The glob already filtered by
+            # extension; this guards against mislabelled objects.
+            if not content_type or not content_type.startswith("image/"):
+                continue
+
+            # 2. Exit if the file is empty.
+            if file_size == 0:
+                continue
+
+            # 3. Exit if the file is already processed.
+            if 'processed/' in file_path:
+                continue
                 
+            # 4. Check for a custom metadata flag to avoid re-processing
+            if blob.metadata and blob.metadata.get('processed') == 'true':
+                continue
+            if db_key(file_path) in processed:
+                continue
+
+            print(f"Found unprocessed image: {file_path}")
+            uid = blob.metadata.get("uid") if blob.metadata else None
+            public = blob.metadata.get("public") if blob.metadata else None
+            work.put((file_path, content_type, uid, public, file_size, blob.generation))
+    finally:
+        # One stop signal per worker, then wait for the queue to drain.
+        for _ in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+
     print("Scheduled scan finished.")
 
 
@@ -204,20 +392,37 @@ def analyze_untagged_images(event: scheduler_fn.ScheduledEvent) -> None:
     bucket = storage.bucket()
     
     # List blobs in the 'processed/' directory
-    blobs = bucket.list_blobs(prefix='photos/')
+    blobs = bucket.list_blobs(prefix='processed/', fields=LIST_BLOB_FIELDS)
     
     # Get the secret key value once from os.environ
     key = os.environ.get("GEMINI_API_KEY")
+
+    # Fetch the tagged index once instead of checking each image.
+    tagged = tagged_keys()
     
+    pending = []
     for blob in blobs:
-        # Reload the blob to get the latest metadata
-        blob.reload()
-        
+        # The listing already carries content type and metadata, so there
+        # is no need to reload each blob.
         # Check if the blob is an image and not already tagged
         if blob.content_type and blob.content_type.startswith("image/"):
+            if db_key(blob.name) in tagged:
+                continue
             if not blob.metadata or blob.metadata.get('tagged') != 'true':
                 print(f"Found untagged image: {blob.name}")
-                # Pass the key to the analysis function
-                analyze_image(bucket.name, blob.name, key, blob.metadata)
-                
-    print("Scheduled scan for untagged images finished.")
\ No newline at end of file
+                pending.append(blob)
+
+    # Vision batches go out concurrently on one async channel; categorizing
+    # and saving then runs on the scan's worker threads.
+    analyze_images(pending, key, max_workers=SCAN_MAX_WORKERS)
+
+    print("Scheduled scan for untagged images finished.")
+
+
+@scheduler_fn.on_schedule(schedule="every 24 hours")
+def clean_up_seen_generations(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Removes expired entries from the seen-generations index used to skip
+    duplicate storage events.
+    """
+    prune_seen_generations(SEEN_GENERATION_TTL_SECONDS)
@@ -1,193 +1,754 @@
+import asyncio
+import base64
+import hashlib
+import json
 import os
+import secrets
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from urllib.parse import quote
-import google.generativeai as genai
-from google.cloud import vision
 import firebase_admin
 from firebase_admin import db, storage
+from google.api_core.exceptions import NotFound
 # Do not import params here, it's not needed
 
 # This check prevents re-initializing the app if it's already been done.
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
-def analyze_image(bucket_name, file_path, gemini_api_key, metadata=None):
+# RTDB sentinel that the server replaces with its own write time.
+SERVER_TIMESTAMP = {".sv": "timestamp"}
+
+# Alphabet used by Firebase push IDs; ordered so keys sort chronologically.
+_PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+# The Vision and Gemini libraries are slow to import, and not every function
+# in this codebase needs them, so they are loaded on first use.
+@lru_cache(maxsize=None)
+def _vision():
     """
-    Uses Cloud Vision AI to tag an image and saves the tags to the Realtime Database.
-    This function is designed to be called from another Cloud Function.
-    The Gemini API key is passed as an argument.
+    Returns the Cloud Vision module, importing it on first use.
     """
-    bucket = storage.bucket(bucket_name)
-    blob = bucket.blob(file_path)
+    from google.cloud import vision
+    return vision
+
+@lru_cache(maxsize=None)
+def _genai():
+    """
+    Returns the Gemini SDK module, importing it on first use.
+    """
+    import google.generativeai as genai
+    return genai
+
+# Clients are created on first use and reused for the life of a warm instance,
+# so the gRPC channel, credentials and TLS session are not set up per image.
+_vision_client = None
+_buckets = {}
+
+def _get_vision_client():
+    """
+    Returns the shared Vision client, creating it on first use.
+    """
+    global _vision_client
+    if _vision_client is None:
+        _vision_client = _vision().ImageAnnotatorClient()
+    return _vision_client
+
+def get_bucket(bucket_name):
+    """
+    Returns a cached storage bucket handle for the given name.
+    """
+    bucket = _buckets.get(bucket_name)
+    if bucket is None:
+        bucket = _buckets[bucket_name] = storage.bucket(bucket_name)
+    return bucket
+
+# Maximum number of images Vision accepts in one batch_annotate_images call.
+VISION_BATCH_SIZE = 16
+
+# Maximum number of labels requested from Vision per image.
+VISION_MAX_LABELS = 10
+
+# Text detection is billed separately from labels, so it can be turned off.
+# SafeSearch is free alongside label detection and is always requested.
+VISION_DETECT_TEXT = os.environ.get("VISION_DETECT_TEXT", "true").lower() == "true"
+
+# Only the fields below are read from Vision responses, so every request
+# asks for just those.
+VISION_RESPONSE_METADATA = [(
+    'x-goog-fieldmask',
+    'responses.label_annotations.description,'
+    'responses.text_annotations.description,'
+    'responses.safe_search_annotation,'
+    'responses.error',
+)]
+
+# Maximum number of Vision batch requests in flight at once in scheduled scans.
+VISION_MAX_IN_FLIGHT = 32
+
+# RTDB node listing the storage paths that have already been analyzed.
+TAGS_DONE_PATH = 'tags_done'
+
+def db_key(path):
+    """
+    Escapes a storage path for use as a single RTDB key.
+    Keys may not contain '/', '.', '#', '$', '[' or ']'.
+    """
+    return quote(path, safe='').replace('.', '%2E')
+
+def tagged_keys():
+    """
+    Returns the set of db_key()-escaped paths that have already been tagged.
+    Fetched shallowly, so only the keys are transferred.
+    """
+    return set(db.reference(TAGS_DONE_PATH).get(shallow=True) or {})
 
-    # It's crucial to reload the blob to get the very latest metadata,
-    # especially if another function has just modified it.
-    blob.reload()
-    current_metadata = blob.metadata or {}
+# RTDB node recording which object generations have been analyzed, so
+# retried or duplicate trigger deliveries are skipped.
+SEEN_GENERATIONS_PATH = 'seen_generations'
+
+def seen_generation_key(file_path, generation):
+    """
+    Returns the RTDB key recording that a generation of an object was handled.
+    """
+    return db_key(f"{file_path}#{generation}")
+
+def generation_seen(seen_key):
+    """
+    Checks whether the seen-generation entry for seen_key exists.
+    """
+    return bool(db.reference(f'{SEEN_GENERATIONS_PATH}/{seen_key}').get(shallow=True))
+
+def prune_seen_generations(max_age_seconds):
+    """
+    Deletes seen-generation entries older than max_age_seconds.
+    Entries are keyed by path and generation and hold the server timestamp of
+    when they were written.
+    """
+    cutoff = int((time.time() - max_age_seconds) * 1000)
+    expired = db.reference(SEEN_GENERATIONS_PATH).order_by_value().end_at(cutoff).get() or {}
+    if expired:
+        db.reference(SEEN_GENERATIONS_PATH).update({key: None for key in expired})
+    print(f"Pruned {len(expired)} seen generation(s).")
+
+def _push_key():
+    """
+    Generates a Firebase-style push ID locally.
+    The Admin SDK's Reference.push() creates the child with a server request,
+    which is wasted when the value is written later in a multi-path update.
+    """
+    now = int(time.time() * 1000)
+    timestamp_chars = []
+    for _ in range(8):
+        timestamp_chars.append(_PUSH_CHARS[now % 64])
+        now //= 64
+    random_chars = [secrets.choice(_PUSH_CHARS) for _ in range(12)]
+    return ''.join(reversed(timestamp_chars)) + ''.join(random_chars)
+
+def _image_key(user_id, md5_hash):
+    """
+    Returns the RTDB key for a user's image entry.
+    The key is derived from the MD5 hash Cloud Storage already computed for
+    the object, so uploading the same content again maps to the same entry.
+    The user ID is mixed in so identical images from different users keep
+    separate public references. Falls back to a push ID without a hash.
+    """
+    if not md5_hash:
+        return _push_key()
+    digest = hashlib.sha1(f"{user_id}:{md5_hash}".encode()).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:16]
+
+def _analysis_markers(file_path, seen_key=None):
+    """
+    Returns the multi-path updates flagging an object as analyzed, and the
+    triggering event's seen-generation entry when its key is given.
+    """
+    markers = {f'{TAGS_DONE_PATH}/{db_key(file_path)}': SERVER_TIMESTAMP}
+    if seen_key:
+        markers[f'{SEEN_GENERATIONS_PATH}/{seen_key}'] = SERVER_TIMESTAMP
+    return markers
+
+def _public_reference(user_image_path, image_url, category, user_id):
+    """
+    Returns the lightweight images/public entry pointing at a user's image.
+    """
+    return {
+        'userImagePath': user_image_path,
+        'imageUrl': image_url,
+        'category': category,
+        'uid': user_id,
+        'createdAt': SERVER_TIMESTAMP
+    }
+
+def _already_saved(blob, user_id, image_key, is_public=None, seen_key=None):
+    """
+    Checks whether the user already has an entry for this image's content.
+    If so, the object is flagged as analyzed so it is not picked up again,
+    and True is returned. A public upload of content saved earlier marks the
+    existing entry public and adds its public reference.
+    """
+    user_image_path = f'users/{user_id}/images/{image_key}'
+    # The full entry is only needed to build a public reference.
+    existing = db.reference(user_image_path).get(shallow=not is_public)
+    if not existing:
+        return False
+
+    updates = _analysis_markers(blob.name, seen_key)
+    if is_public:
+        updates[f'{user_image_path}/public'] = is_public
+        updates[f'images/public/{image_key}'] = _public_reference(
+            user_image_path, existing.get('imageUrl'), existing.get('category'), user_id
+        )
+    db.reference().update(updates)
+    print(f"'{blob.name}' has the same content as image {image_key} of user {user_id}. Skipping analysis.")
+    return True
+
+# Smart Album categories an image can be sorted into.
+CATEGORIES = (
+    'People',
+    'Pets',
+    'Places & Travel',
+    'Food & Drink',
+    'Events & Activities',
+    'Art & Design',
+    'Screenshots & Recordings',
+    'Documents & Text',
+    'Other',
+)
+
+# Static Gemini instructions for picking a Smart Album from Vision labels.
+# Kept separate from the per-image labels so every request shares the same prefix.
+SMART_ALBUM_INSTRUCTION = (
+    'Role: You are an expert photo organization AI. Your job is to analyze a list of raw, messy labels from Google Cloud Vision and categorize the photo into one single, user-friendly "Smart Album".\n\n'
+    'Your Smart Album categories are:\n\n'
+    + "\n".join(CATEGORIES)
+    + '\n\nRespond with only the single best category name from the list. Do not add any other text.'
+)
+
+# Fixed start of the per-image prompt; only the labels are appended to it.
+_PROMPT_PREFIX = "Labels: "
+
+@lru_cache(maxsize=4)
+def _gemini_model(gemini_api_key):
+    """
+    Returns the Smart Album Gemini model for an API key, configuring the
+    client once per warm instance instead of on every image.
+    """
+    genai = _genai()
+    genai.configure(api_key=gemini_api_key)
+    return genai.GenerativeModel(
+        'gemini-2.5-flash-lite',
+        system_instruction=SMART_ALBUM_INSTRUCTION,
+        # Constrain the answer to exactly one category name, decoded greedily.
+        generation_config={
+            'temperature': 0,
+            'max_output_tokens': 16,
+            'response_mime_type': 'text/x.enum',
+            'response_schema': {'type': 'STRING', 'enum': list(CATEGORIES)},
+        },
+    )
+
+def _stream_category(model, prompt):
+    """
+    Streams Gemini's answer and stops reading as soon as the text so far
+    can only be one category, instead of waiting for the end of the stream.
+    Returns the raw text if it stops matching any category.
+    """
+    text = ''
+    for chunk in model.generate_content(prompt, stream=True):
+        try:
+            text += chunk.text
+        except ValueError:
+            # Chunks without text (e.g. the final finish-reason chunk).
+            continue
+        answer = text.strip()
+        matches = [category for category in CATEGORIES if category.startswith(answer)]
+        if len(matches) == 1:
+            return matches[0]
+        if not matches:
+            break
+    return text.strip()
+
+# RTDB node caching Gemini's category for each distinct set of Vision labels.
+CATEGORY_CACHE_PATH = 'caches/gemini_category'
+
+@lru_cache(maxsize=1024)
+def _gemini_category(sorted_tags, gemini_api_key):
+    """
+    Returns the Smart Album category for a sorted tuple of Vision labels.
+    The prompt only depends on the label set, so results are cached in memory
+    for the life of a warm instance and in the Realtime Database across
+    instances, and Gemini is only asked about label sets it has not seen.
+    Raises ValueError if Gemini answers with something other than a category.
+    """
+    cache_key = hashlib.sha1(",".join(sorted_tags).encode()).hexdigest()
+    ref = db.reference(CATEGORY_CACHE_PATH).child(cache_key)
+    cached = ref.get()
+    if cached and cached.get('category'):
+        return cached['category']
+
+    # Use Gemini to get a smart category
+    model = _gemini_model(gemini_api_key)
+
+    # Only the labels vary between calls; the static instructions are sent as
+    # the system instruction, so they form the same leading part of every request.
+    prompt = _PROMPT_PREFIX + ", ".join(sorted_tags)
+    category = _stream_category(model, prompt)
+    if category not in CATEGORIES:
+        # Raised rather than returned so lru_cache does not memoize it.
+        raise ValueError(f"Gemini returned an unknown category '{category}'")
+
+    ref.set({'category': category, 'createdAt': SERVER_TIMESTAMP})
+    return category
+
+# Vision labels that clearly point at one Smart Album, so most images can be
+# categorized without asking Gemini. Keys are lowercase.
+LABEL_TO_CATEGORY = {
+    'person': 'People', 'people': 'People', 'face': 'People', 'smile': 'People',
+    'selfie': 'People', 'child': 'People', 'baby': 'People', 'portrait': 'People',
+    'hairstyle': 'People', 'facial expression': 'People',
+    'dog': 'Pets', 'cat': 'Pets', 'puppy': 'Pets', 'kitten': 'Pets',
+    'dog breed': 'Pets', 'carnivore': 'Pets', 'whiskers': 'Pets', 'pet supply': 'Pets',
+    'companion dog': 'Pets', 'small to medium-sized cats': 'Pets',
+    'sky': 'Places & Travel', 'landscape': 'Places & Travel', 'building': 'Places & Travel',
+    'mountain': 'Places & Travel', 'beach': 'Places & Travel', 'city': 'Places & Travel',
+    'landmark': 'Places & Travel', 'tourism': 'Places & Travel', 'travel': 'Places & Travel',
+    'cloud': 'Places & Travel', 'water': 'Places & Travel', 'architecture': 'Places & Travel',
+    'food': 'Food & Drink', 'dish': 'Food & Drink', 'cuisine': 'Food & Drink',
+    'ingredient': 'Food & Drink', 'recipe': 'Food & Drink', 'tableware': 'Food & Drink',
+    'drink': 'Food & Drink', 'dessert': 'Food & Drink', 'baked goods': 'Food & Drink',
+    'drinkware': 'Food & Drink',
+    'event': 'Events & Activities', 'party': 'Events & Activities', 'crowd': 'Events & Activities',
+    'sports': 'Events & Activities', 'wedding': 'Events & Activities', 'concert': 'Events & Activities',
+    'fun': 'Events & Activities', 'leisure': 'Events & Activities', 'ceremony': 'Events & Activities',
+    'art': 'Art & Design', 'painting': 'Art & Design', 'illustration': 'Art & Design',
+    'drawing': 'Art & Design', 'graphic design': 'Art & Design', 'graphics': 'Art & Design',
+    'visual arts': 'Art & Design', 'sketch': 'Art & Design',
+    'screenshot': 'Screenshots & Recordings', 'software': 'Screenshots & Recordings',
+    'multimedia': 'Screenshots & Recordings', 'web page': 'Screenshots & Recordings',
+    'operating system': 'Screenshots & Recordings', 'computer icon': 'Screenshots & Recordings',
+    'document': 'Documents & Text', 'paper': 'Documents & Text', 'handwriting': 'Documents & Text',
+    'receipt': 'Documents & Text', 'paper product': 'Documents & Text', 'letter': 'Documents & Text',
+}
+
+# Labels Vision attaches to almost any image; they say nothing about its category.
+_GENERIC_LABELS = frozenset({
+    "Image", "Photograph", "Photography", "Rectangle", "Font", "Pattern",
+})
+
+# Images with at least this many words of detected text are filed as
+# screenshots or documents without asking Gemini.
+TEXT_CATEGORY_MIN_WORDS = 20
+
+# RTDB node holding label -> category overrides that are merged over
+# LABEL_TO_CATEGORY, so the table can be tuned without a redeploy.
+LABEL_MAP_CONFIG_PATH = 'config/label_map'
+
+@lru_cache(maxsize=1)
+def _label_map():
+    """
+    Returns the label -> category table, loading the RTDB overrides once per
+    warm instance. Overrides naming an unknown category are ignored, and if
+    they cannot be read the built-in table is used on its own.
+    """
+    label_map = dict(LABEL_TO_CATEGORY)
+    try:
+        overrides = db.reference(LABEL_MAP_CONFIG_PATH).get() or {}
+        for label, category in overrides.items():
+            if category in CATEGORIES:
+                label_map[label.lower()] = category
+            else:
+                print(f"Ignoring label map override '{label}': unknown category '{category}'.")
+    except Exception as e:
+        print(f"Could not load label map overrides ({e}). Using the built-in table.")
+        return dict(LABEL_TO_CATEGORY)
+    return label_map
+
+def _rule_category(all_tags):
+    """
+    Picks a category from the label table when the labels clearly agree.
+    The winning category needs at least two votes and twice as many as the
+    runner-up; otherwise None is returned and Gemini decides.
+    """
+    label_map = _label_map()
+    votes = Counter(label_map[tag.lower()] for tag in all_tags if tag.lower() in label_map)
+    ranked = votes.most_common(2)
+    if not ranked:
+        return None
+    winner, count = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    if count >= 2 and count >= 2 * runner_up:
+        return winner
+    return None
+
+def _text_category(all_tags, text):
+    """
+    Returns 'Screenshots & Recordings' or 'Documents & Text' for images that
+    carry a substantial amount of text, or None otherwise. Labels that point
+    at a screen decide between the two.
+    """
+    if len(text.split()) < TEXT_CATEGORY_MIN_WORDS:
+        return None
+    label_map = _label_map()
+    if any(label_map.get(tag.lower()) == 'Screenshots & Recordings' for tag in all_tags):
+        return 'Screenshots & Recordings'
+    return 'Documents & Text'
+
+def _categorize(all_tags, gemini_api_key, text=''):
+    """
+    Returns (category, source) for an image's Vision labels, using the
+    detected text or the label table when they are conclusive and Gemini
+    otherwise. Images with only generic labels are filed under 'Other'
+    without asking Gemini. The source names which of these decided.
+    """
+    category = _text_category(all_tags, text)
+    if category:
+        return category, 'text'
+
+    meaningful = [tag for tag in all_tags if tag not in _GENERIC_LABELS]
+    if not meaningful:
+        return 'Other', 'generic'
+
+    category = _rule_category(meaningful)
+    if category:
+        return category, 'labels'
+    try:
+        return _gemini_category(tuple(sorted(meaningful)), gemini_api_key), 'gemini'
+    except ValueError as e:
+        print(f"{e}. Using 'Other'.")
+        return 'Other', 'gemini'
+
+def _image_context(blob, metadata=None):
+    """
+    Checks the blob's metadata and returns (user_id, is_public) for an image
+    that should be analyzed, or None if it must be skipped. Metadata the
+    caller already has can be passed in place of the blob's own.
+    """
+    current_metadata = (blob.metadata if metadata is None else metadata) or {}
 
     # 1. Safeguard: Exit if the image has already been tagged.
     if current_metadata.get("tagged") == "true":
-        print(f"Image '{file_path}' has already been tagged. Skipping analysis.")
-        return
+        print(f"Image '{blob.name}' has already been tagged. Skipping analysis.")
+        return None
 
     # 2. Extract user ID and public status from metadata
     user_id = current_metadata.get('uid')
     is_public = current_metadata.get('public')
 
     if not user_id:
-        print(f"Could not find user ID in metadata for {file_path}. Skipping analysis.")
-        return
+        print(f"Could not find user ID in metadata for {blob.name}. Skipping analysis.")
+        return None
+
+    return user_id, is_public
 
-    print(f"Analyzing image: {file_path} for user: {user_id}")
+def _save_analysis(blob, annotations, user_id, is_public, gemini_api_key, image_key, seen_key=None):
+    """
+    Categorizes an image from its Vision annotations and saves the result
+    to the Realtime Database under image_key. When the triggering event's
+    seen-generation key is given, it is recorded in the same write.
+    """
+    all_tags = annotations['tags']
+    file_path = blob.name
 
-    # 3. Get public URL of the image.
+    # Get public URL of the image.
     image_url = blob.public_url
 
-    # 4. Use Vision AI to detect labels.
-    # Download the image content instead of using GCS URI to avoid timing issues
-    vision_client = vision.ImageAnnotatorClient()
-    image_content = blob.download_as_bytes()
-    image = vision.Image(content=image_content)
+    category, category_source = _categorize(all_tags, gemini_api_key, annotations['text'])
 
-    try:
-        response = vision_client.label_detection(image=image)
+    # Save image URL and tags to Realtime Database.
+    user_db_path = f'users/{user_id}/images'
+
+    image_data = {
+        'imageUrl': image_url,
+        'tags': all_tags,
+        'category': category,
+        'safeSearch': annotations['safeSearch'],
+        'createdAt': SERVER_TIMESTAMP,
+        'filePath': file_path,
+        'public': is_public,
+        'uid': user_id
+    }
+
+    user_image_key = image_key
+    updates = {
+        # Save to user's path (primary storage location)
+        f'{user_db_path}/{user_image_key}': image_data,
+    }
+
+    if is_public:
+        # Instead of duplicating data, store a reference to the user's image
+        # Store a lightweight reference with essential public info
+        updates[f'images/public/{user_image_key}'] = _public_reference(
+            f'{user_db_path}/{user_image_key}', image_url, category, user_id
+        )
+
+    # Flag the image as tagged in the same write, instead of patching
+    # the object's metadata with a separate GCS request.
+    updates.update(_analysis_markers(file_path, seen_key))
+
+    # Write the user entry, public reference and tagged flag atomically in one request.
+    db.reference().update(updates)
+
+    # One structured record per image; Cloud Logging indexes the JSON fields.
+    print(json.dumps({
+        'severity': 'INFO',
+        'message': f"Saved analysis of '{file_path}' for user {user_id}.",
+        'filePath': file_path,
+        'uid': user_id,
+        'labels': all_tags,
+        'category': category,
+        'categorySource': category_source,
+        'public': bool(is_public),
+        'key': user_image_key,
+    }))
+
+def _gcs_image(blob):
+    """
+    Returns a Vision image that Vision reads itself from the blob's gs:// URI.
+    """
+    vision = _vision()
+    return vision.Image(source=vision.ImageSource(
+        gcs_image_uri=f"gs://{blob.bucket.name}/{blob.name}"
+    ))
+
+def _annotate_request(image):
+    """
+    Builds one Vision request for everything the analysis reads: labels,
+    SafeSearch and, when enabled, text detection.
+    """
+    vision = _vision()
+    features = [
+        vision.Feature(
+            type_=vision.Feature.Type.LABEL_DETECTION,
+            max_results=VISION_MAX_LABELS,
+        ),
+        vision.Feature(type_=vision.Feature.Type.SAFE_SEARCH_DETECTION),
+    ]
+    if VISION_DETECT_TEXT:
+        features.append(vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION, max_results=1))
+    return vision.AnnotateImageRequest(image=image, features=features)
+
+def _annotations_from_response(blob, response):
+    """
+    Returns the labels, detected text and SafeSearch likelihoods from a
+    Vision response for a stored image, as a dict.
+    If Vision could not read the object from its URI (e.g. it was only just
+    written), the bytes are downloaded and sent inline once instead.
+    """
+    vision = _vision()
+    if response.error.message:
+        print(f"Vision could not read '{blob.name}' from storage ({response.error.message}). Sending the image content instead.")
+        image = vision.Image(content=blob.download_as_bytes())
+        response = _get_vision_client().batch_annotate_images(
+            requests=[_annotate_request(image)], metadata=VISION_RESPONSE_METADATA
+        ).responses[0]
         if response.error.message:
             raise Exception(f"Vision API Error: {response.error.message}")
 
-        labels = response.label_annotations
-        all_tags = [label.description for label in labels]
-        
-        # Use Gemini to get a smart category
-        # Configure with API key passed as an argument
-        genai.configure(api_key=gemini_api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
-        prompt = f"""Role: You are an expert photo organization AI. Your job is to analyze a list of raw, messy labels from Google Cloud Vision and categorize the photo into one single, user-friendly "Smart Album".
+    safe_search = response.safe_search_annotation
+    return {
+        'tags': [label.description for label in response.label_annotations],
+        # The first text annotation holds all of the text found in the image.
+        'text': response.text_annotations[0].description if response.text_annotations else '',
+        'safeSearch': {
+            field: vision.Likelihood(getattr(safe_search, field)).name
+            for field in ('adult', 'spoof', 'medical', 'violence', 'racy')
+        },
+    }
+
+def _annotate_batch(blobs):
+    """
+    Annotates up to VISION_BATCH_SIZE stored images with one Vision request.
+    Returns one entry per blob, in the same order: its annotations, or the
+    exception raised while annotating it.
+    """
+    requests = [_annotate_request(_gcs_image(blob)) for blob in blobs]
+    responses = _get_vision_client().batch_annotate_images(
+        requests=requests, metadata=VISION_RESPONSE_METADATA
+    ).responses
+
+    results = []
+    for blob, response in zip(blobs, responses):
+        try:
+            results.append(_annotations_from_response(blob, response))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def _annotate(blob):
+    """
+    Runs Vision on a single stored image, as a batch of one.
+    """
+    annotations = _annotate_batch([blob])[0]
+    if isinstance(annotations, Exception):
+        raise annotations
+    return annotations
 
-Your Smart Album categories are:
+def analyze_image(bucket_name, file_path, gemini_api_key, metadata=None, seen_key=None, md5_hash=None):
+    """
+    Uses Cloud Vision AI to tag an image and saves the tags to the Realtime Database.
+    This function is designed to be called from another Cloud Function.
+    The Gemini API key is passed as an argument.
+    Pass the seen-generation key of the triggering event (see
+    seen_generation_key) to have it recorded once the image is handled, and
+    the object's custom metadata and MD5 hash, if known, to avoid re-reading
+    them from Storage.
+    """
+    bucket = get_bucket(bucket_name)
+    blob = bucket.blob(file_path)
 
-People
-Pets
-Places & Travel
-Food & Drink
-Events & Activities
-Art & Design
-Screenshots & Recordings
-Documents & Text
-Other
+    # Without metadata from the caller, reload the blob to read its latest
+    # metadata. Callers that already have it (e.g. from the storage event)
+    # skip that extra Storage request.
+    if metadata is None:
+        try:
+            blob.reload()
+        except NotFound:
+            print(f"Blob '{file_path}' no longer exists, likely deleted by another process. Skipping.")
+            return
+        md5_hash = blob.md5_hash
+    context = _image_context(blob, metadata)
+    if context is None:
+        if seen_key:
+            db.reference(f'{SEEN_GENERATIONS_PATH}/{seen_key}').set(SERVER_TIMESTAMP)
+        return
+    user_id, is_public = context
 
-Respond with only the single best category name from the list. Do not add any other text.
+    # Skip Vision and Gemini entirely for content the user already has.
+    image_key = _image_key(user_id, md5_hash)
+    if md5_hash and _already_saved(blob, user_id, image_key, is_public, seen_key):
+        return
 
-Current File Path:
-{", ".join(all_tags)}"""
-        
-        response = model.generate_content(prompt)
-        category = response.text.strip()
+    try:
+        # Use Vision AI to detect labels, text and SafeSearch in one request.
+        annotations = _annotate(blob)
 
-        print(f"All labels detected: {', '.join(all_tags)}")
-        print(f"Smart Album category: {category}")
-
-        # 5. Save image URL and tags to Realtime Database.
-        user_db_path = f'users/{user_id}/images'
-
-        image_data = {
-            'imageUrl': image_url,
-            'tags': all_tags,
-            'category': category,
-            'createdAt': {".sv": "timestamp"},
-            'filePath': file_path,
-            'public': is_public,
-            'uid': user_id
-        }
-        
-        # Save to user's path (primary storage location)
-        user_image_ref = db.reference(user_db_path).push()
-        user_image_ref.set(image_data)
-        user_image_key = user_image_ref.key
-        print(f"Successfully saved tags to database for user {user_id} with key {user_image_key}.")
-
-        if is_public:
-            # Instead of duplicating data, store a reference to the user's image
-            public_db_path = 'images/public'
-            public_image_ref = db.reference(public_db_path).child(user_image_key)
-            
-            # Store a lightweight reference with essential public info
-            public_reference = {
-                'userImagePath': f'{user_db_path}/{user_image_key}',
-                'imageUrl': image_url,
-                'category': category,
-                'uid': user_id,
-                'createdAt': {".sv": "timestamp"}
-            }
-            public_image_ref.set(public_reference)
-            print(f"Successfully saved public reference to database with key {user_image_key}.")
-
-        # 6. Update metadata with analysis flags.
-        current_metadata['tagged'] = 'true'
-        current_metadata['processed'] = 'true'
-        current_metadata['uid'] = user_id
-        current_metadata['public'] = str(is_public).lower()
-        blob.metadata = current_metadata
-        blob.patch()
-        print(f"Metadata updated for '{file_path}' with analysis flags.")
+        _save_analysis(blob, annotations, user_id, is_public, gemini_api_key, image_key, seen_key)
 
+    except NotFound:
+        print(f"Blob '{file_path}' no longer exists, likely deleted by another process. Skipping.")
     except Exception as e:
-        if "No such object" in str(e):
-            print(f"Blob '{file_path}' not found during patch, likely updated by another process. Skipping.")
-        else:
-            print(f"An error occurred during image analysis for '{file_path}': {e}")
+        print(f"An error occurred during image analysis for '{file_path}': {e}")
+
+async def _annotate_batches_async(request_batches):
+    """
+    Sends all Vision batches concurrently over one async client, keeping at
+    most VISION_MAX_IN_FLIGHT requests open. Returns one result per batch,
+    in order: the response, or the exception that batch raised.
+    """
+    vision = _vision()
+    # The async client is bound to the running event loop, so it is created
+    # here rather than cached like the sync client.
+    client = vision.ImageAnnotatorAsyncClient()
+    limit = asyncio.Semaphore(VISION_MAX_IN_FLIGHT)
+
+    async def annotate(requests):
+        async with limit:
+            return await client.batch_annotate_images(requests=requests, metadata=VISION_RESPONSE_METADATA)
+
+    try:
+        return await asyncio.gather(
+            *(annotate(requests) for requests in request_batches),
+            return_exceptions=True,
+        )
+    finally:
+        # Close the grpc.aio channel before asyncio.run() shuts the loop down.
+        await client.transport.close()
+
+def analyze_images(blobs, gemini_api_key, max_workers=1):
+    """
+    Batch variant of analyze_image for the scheduled scans.
+    Takes listed blobs (with metadata and MD5 hashes already populated),
+    skips content the user already has, and labels up to
+    VISION_BATCH_SIZE of them per Vision request, reading each image
+    straight from Cloud Storage by its gs:// URI. Multiple batches are sent
+    concurrently; the Gemini and database step then runs on up to
+    max_workers threads.
+    """
+    contexts = []
+    for blob in blobs:
+        context = _image_context(blob)
+        if context is not None:
+            user_id, is_public = context
+            contexts.append((blob, user_id, is_public, _image_key(user_id, blob.md5_hash)))
+
+    # Drop images whose content the user already has before paying for Vision.
+    def is_new(item):
+        blob, user_id, is_public, image_key = item
+        try:
+            return not (blob.md5_hash and _already_saved(blob, user_id, image_key, is_public))
+        except Exception as e:
+            print(f"Could not check for an existing entry for '{blob.name}': {e}")
+            return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        candidates = [item for item, new in zip(contexts, executor.map(is_new, contexts)) if new]
+
+    if not candidates:
+        return
+
+    chunks = [
+        candidates[start:start + VISION_BATCH_SIZE]
+        for start in range(0, len(candidates), VISION_BATCH_SIZE)
+    ]
+    request_batches = [
+        [_annotate_request(_gcs_image(blob)) for blob, _, _, _ in chunk]
+        for chunk in chunks
+    ]
+    print(f"Analyzing {len(candidates)} image(s) in {len(request_batches)} Vision batch(es).")
+
+    if len(request_batches) == 1:
+        try:
+            results = [_get_vision_client().batch_annotate_images(
+                requests=request_batches[0], metadata=VISION_RESPONSE_METADATA
+            )]
+        except Exception as e:
+            results = [e]
+    else:
+        results = asyncio.run(_annotate_batches_async(request_batches))
+
+    labelled = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            print(f"An error occurred during batch label detection: {result}")
+            continue
+        # Responses come back in request order.
+        labelled.extend(zip(chunk, result.responses))
+
+    def save(item):
+        (blob, user_id, is_public, image_key), response = item
+        try:
+            annotations = _annotations_from_response(blob, response)
+            _save_analysis(blob, annotations, user_id, is_public, gemini_api_key, image_key)
+
+        except Exception as e:
+            print(f"An error occurred during image analysis for '{blob.name}': {e}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(save, labelled))
 
 def process_image_without_metadata_check(bucket_name, file_path, gemini_api_key):
     """
     Uses Cloud Vision AI to tag an image for local testing without metadata checks.
     The Gemini API key is passed as an argument.
     """
-    bucket = storage.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(file_path)
 
     print(f"Analyzing image locally: {file_path}")
 
-    # Use Vision AI to detect labels.
-    # Download the image content instead of using GCS URI to avoid timing issues
-    vision_client = vision.ImageAnnotatorClient()
-    image_content = blob.download_as_bytes()
-    image = vision.Image(content=image_content)
-
     try:
-        response = vision_client.label_detection(image=image)
-        if response.error.message:
-            raise Exception(f"Vision API Error: {response.error.message}")
+        # Use Vision AI to detect labels.
+        annotations = _annotate(blob)
+        all_tags = annotations['tags']
 
-        labels = response.label_annotations
-        all_tags = [label.description for label in labels]
-        
         # Use Gemini to get a smart category
-        genai.configure(api_key=gemini_api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
-        prompt = f"""Role: You are an expert photo organization AI. Your job is to analyze a list of raw, messy labels from Google Cloud Vision and categorize the photo into one single, user-friendly "Smart Album".
-
-Your Smart Album categories are:
-
-People 
-Pets
-Places & Travel
-Food & Drink
-Events & Activities
-Art & Design
-Screenshots & Recordings
-Documents & Text
-Other
-
-Respond with only the single best category name from the list. Do not add any other text.
-
-Current File Path:
-{", ".join(all_tags)}"""
-        
-        response = model.generate_content(prompt)
-        category = response.text.strip()
+        category, category_source = _categorize(all_tags, gemini_api_key, annotations['text'])
 
         print(f"All labels detected: {', '.join(all_tags)}")
-        print(f"Smart Album category: {category}")
+        print(f"Smart Album category: {category} (from {category_source})")
 
     except Exception as e:
         print(f"An error occurred during local image analysis for '{file_path}': {e}")
\ No newline at end of file